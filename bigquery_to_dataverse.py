@@ -1,17 +1,38 @@
 import os
+import atexit
+import collections
+import functools
+import gc
+import gzip
 import json
-import time
-import uuid
-import pytz
+import itertools
 import logging
+import logging.handlers
+import queue
 import random
-from datetime import datetime
-from typing import List, Tuple
+import re
+import secrets
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from datetime import timezone
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import msal
+import pyarrow as pa
+import pyarrow.compute as pc
 from dotenv import load_dotenv
 from google.cloud import bigquery
+from google.cloud import bigquery_storage
+
+try:
+    import orjson
+except ImportError:         # fall back to the stdlib encoder
+    orjson = None
 
 # ----------------------------
 # Config & Logging
@@ -19,18 +40,35 @@ from google.cloud import bigquery
 load_dotenv()
 
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Threads only enqueue records; a background listener formats and writes them,
+# so POST workers never wait on the stream handler's lock or write().
+LOG_QUEUE: queue.Queue = queue.Queue(-1)
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+_log_enqueue = logging.handlers.QueueHandler(LOG_QUEUE)
+_log_enqueue.setFormatter(logging.Formatter("%(message)s"))  # final format is applied by _log_output
 logging.basicConfig(
     level=getattr(logging, LOG_LEVEL, logging.INFO),
-    format="%(asctime)s %(levelname)s %(message)s"
+    handlers=[_log_enqueue]
 )
+LOG_LISTENER = logging.handlers.QueueListener(LOG_QUEUE, _log_output)
+LOG_LISTENER.start()
+atexit.register(LOG_LISTENER.stop)  # flushes queued records on exit
 log = logging.getLogger("bq2dv")
 
 PROJECT = os.getenv("GOOGLE_PROJECT")
 BQ_TABLE = os.getenv("BQ_TABLE", "crm_ds.customers")                  # dataset.table
 PAGE_SIZE = int(os.getenv("PAGE_SIZE", "5000"))
 BATCH_SIZE = int(os.getenv("BATCH_SIZE", "50"))
+PREFETCH_BATCHES = 2                                                  # Arrow batches buffered ahead of the POSTs
+PAGES_IN_FLIGHT = 2                                                   # pages posted but not yet checkpointed
+BQ_READ_MODE = os.getenv("BQ_READ_MODE", "query").lower()            # "query" or "storage" (direct table read)
+DV_CONCURRENCY = int(os.getenv("DV_CONCURRENCY", "6"))               # concurrent $batch POSTs
+CHUNKS_IN_FLIGHT = 2 * DV_CONCURRENCY                                 # built payloads queued or being POSTed
+DV_GZIP_LEVEL = int(os.getenv("DV_GZIP_LEVEL", "0"))                 # gzip $batch bodies (1-9); 0 = off
 WATERMARK_FILE = os.getenv("WATERMARK_FILE", "watermark.json")
 DEFAULT_WATERMARK = os.getenv("DEFAULT_WATERMARK", "2020-01-01T00:00:00Z")
+WATERMARK_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"                           # UTC ISO-8601 with Z
 
 DATAVERSE_URL = os.getenv("DATAVERSE_URL").rstrip("/")
 TENANT_ID = os.getenv("TENANT_ID")
@@ -40,11 +78,87 @@ CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 # Dataverse entity config (adjust to your table)
 DV_ENTITY = "new_customers"     # logical name (not display name)
 ALT_KEY_NAME = "externalid"     # alternate key attribute logical name
+# Set SAFE_EXTERNALID=1 only if external ids are validated upstream to contain no quotes
+SAFE_EXTERNALID = os.getenv("SAFE_EXTERNALID", "0") == "1"
+ODATA_QUOTE_ESCAPE = str.maketrans({"'": "''"})
+
+# BigQuery columns, in SELECT order; record batches are read by these positions
+BQ_COLUMNS = ("externalid", "name", "email", "phone", "updated_at")
+COL_EXTERNALID, COL_NAME, COL_EMAIL, COL_PHONE, COL_UPDATED_AT = range(len(BQ_COLUMNS))
 
 # Safety limits
 MAX_RETRIES = 6                 # per HTTP call
 BASE_BACKOFF = 2.0              # seconds
+MAX_BACKOFF = 60.0              # seconds
 MAX_BATCH_PER_RUN = None        # set an int to hard-cap records per execution
+HTTP_TIMEOUT = (5, 60)          # (connect, read) seconds
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+INNER_RETRIES = 1               # extra attempts for rows that failed inside a $batch with a retryable status
+TOKEN_REFRESH_MARGIN = 300      # seconds before expiry to refresh the access token
+
+# ----------------------------
+# JSON helpers (orjson when available; both return/accept UTF-8 bytes)
+# ----------------------------
+if orjson is not None:
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+else:
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    json_loads = json.loads
+
+# ----------------------------
+# HTTP session (pooled keep-alive connections, reused for the whole run)
+# ----------------------------
+class DecorrelatedJitterRetry(Retry):
+    """
+    urllib3 Retry using decorrelated jitter instead of fixed exponential steps:
+      sleep = min(backoff_max, uniform(backoff_factor, previous_sleep * 3))
+    Workers throttled at the same moment spread their retries out instead of
+    coming back together. Each thread draws from its own random.Random.
+    """
+    _local = threading.local()
+
+    def __init__(self, *args, backoff_value: float = 0.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.backoff_value = backoff_value
+
+    def increment(self, method=None, url=None, response=None, error=None, *args, **kwargs) -> "DecorrelatedJitterRetry":
+        new_retry = super().increment(method, url, response, error, *args, **kwargs)
+        rng = getattr(self._local, "rng", None)
+        if rng is None:
+            rng = self._local.rng = random.Random()
+        previous = max(self.backoff_value, self.backoff_factor)
+        new_retry.backoff_value = min(self.backoff_max, rng.uniform(self.backoff_factor, previous * 3))
+
+        # urllib3 only logs retries at DEBUG; surface throttling/outages to operators
+        retry_after = self.get_retry_after(response) if response is not None else None
+        wait = retry_after if retry_after is not None and self.respect_retry_after_header else new_retry.backoff_value
+        log.warning("HTTP %s -> %s. Retrying in %.2fs (attempt %d/%d)",
+                    method, response.status if response is not None else repr(error),
+                    wait, len(new_retry.history), MAX_RETRIES)
+        return new_retry
+
+    def get_backoff_time(self) -> float:
+        return self.backoff_value
+
+# Retry/backoff policy, applied by urllib3 inside the adapter:
+# decorrelated jitter backoff, honouring Retry-After on 429/503.
+RETRY = DecorrelatedJitterRetry(
+    total=MAX_RETRIES,
+    backoff_factor=BASE_BACKOFF,
+    backoff_max=MAX_BACKOFF,
+    status_forcelist=RETRYABLE_STATUSES,
+    allowed_methods=frozenset(["POST", "PATCH", "GET"]),
+    respect_retry_after_header=True,
+    raise_on_status=False,      # hand the last response back so it can be logged
+)
+
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=8,
+                                      pool_maxsize=max(32, DV_CONCURRENCY),
+                                      max_retries=RETRY))
 
 # ----------------------------
 # Watermark persistence
@@ -52,44 +166,88 @@ MAX_BATCH_PER_RUN = None        # set an int to hard-cap records per execution
 def load_watermark() -> str:
     if os.path.exists(WATERMARK_FILE):
         try:
-            with open(WATERMARK_FILE, "r") as f:
-                data = json.load(f)
+            with open(WATERMARK_FILE, "rb") as f:
+                data = json_loads(f.read())
                 return data.get("last", DEFAULT_WATERMARK)
         except Exception as e:
             log.warning("Failed to read watermark file: %s", e)
     return DEFAULT_WATERMARK
 
+def to_watermark(ts) -> str:
+    """Format an updated_at value (datetime or string) as a UTC watermark string."""
+    # updated_at can be datetime or string
+    if isinstance(ts, str):
+        return ts
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.astimezone(timezone.utc).strftime(WATERMARK_FORMAT)
+
+WATERMARK_TMP = WATERMARK_FILE + ".tmp"
+WATERMARK_DIR = os.path.dirname(os.path.abspath(WATERMARK_FILE))
+
 def save_watermark(wm: str) -> None:
-    tmp = WATERMARK_FILE + ".tmp"
-    with open(tmp, "w") as f:
-        json.dump({"last": wm}, f)
-    os.replace(tmp, WATERMARK_FILE)
+    # fsync the data before the rename, and the directory after it, so a crash
+    # leaves either the old or the new watermark on disk, never an empty file.
+    fd = os.open(WATERMARK_TMP, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, json_dumps({"last": wm}))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(WATERMARK_TMP, WATERMARK_FILE)
+    if hasattr(os, "O_DIRECTORY"):  # not available (or needed) on Windows
+        dfd = os.open(WATERMARK_DIR, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dfd)
+        finally:
+            os.close(dfd)
 
 # ----------------------------
 # Auth: Dataverse token
 # ----------------------------
+# One MSAL app per process so its in-memory token cache survives across calls
+_MSAL_APP = None
+_TOKEN = None
+_TOKEN_EXPIRES_AT = 0.0
+_TOKEN_LOCK = threading.Lock()
+
 def acquire_token() -> str:
-    app = msal.ConfidentialClientApplication(
-        client_id=CLIENT_ID,
-        client_credential=CLIENT_SECRET,
-        authority=f"https://login.microsoftonline.com/{TENANT_ID}"
-    )
-    scope = [f"{DATAVERSE_URL}/.default"]
-    result = app.acquire_token_for_client(scopes=scope)
-    if "access_token" not in result:
-        raise RuntimeError(f"Token acquisition failed: {result}")
-    return result["access_token"]
+    """
+    Return a Dataverse access token. The token is reused until it is within
+    TOKEN_REFRESH_MARGIN of expiry, then refreshed via acquire_token_for_client
+    (which serves MSAL's own token cache before calling AAD).
+    Safe to call from the POST worker threads.
+    """
+    global _MSAL_APP, _TOKEN, _TOKEN_EXPIRES_AT
+    with _TOKEN_LOCK:
+        if _TOKEN and time.time() < _TOKEN_EXPIRES_AT:
+            return _TOKEN
+
+        if _MSAL_APP is None:
+            _MSAL_APP = msal.ConfidentialClientApplication(
+                client_id=CLIENT_ID,
+                client_credential=CLIENT_SECRET,
+                authority=f"https://login.microsoftonline.com/{TENANT_ID}"
+            )
+        scope = [f"{DATAVERSE_URL}/.default"]
+        result = _MSAL_APP.acquire_token_for_client(scopes=scope)
+        if "access_token" not in result:
+            raise RuntimeError(f"Token acquisition failed: {result}")
+
+        _TOKEN = result["access_token"]
+        _TOKEN_EXPIRES_AT = time.time() + int(result.get("expires_in", 0)) - TOKEN_REFRESH_MARGIN
+        return _TOKEN
 
 # ----------------------------
-# BigQuery fetch (paged by updated_at)
+# BigQuery fetch (one query per run, streamed as Arrow record batches)
 # ----------------------------
-def fetch_rows_after(bq: bigquery.Client, watermark: str, limit: int) -> List[bigquery.table.Row]:
+def fetch_rows_after(bq: bigquery.Client, bq_storage: bigquery_storage.BigQueryReadClient,
+                     watermark: str) -> Iterator[pa.RecordBatch]:
     sql = f"""
-    SELECT externalid, name, email, phone, updated_at
+    SELECT {", ".join(BQ_COLUMNS)}
     FROM `{PROJECT}.{BQ_TABLE}`
     WHERE updated_at > @last_watermark
     ORDER BY updated_at
-    LIMIT {limit}
     """
     cfg = bigquery.QueryJobConfig(
         query_parameters=[
@@ -97,188 +255,445 @@ def fetch_rows_after(bq: bigquery.Client, watermark: str, limit: int) -> List[bi
         ]
     )
     job = bq.query(sql, job_config=cfg)
-    rows = list(job)
-    return rows
+    # Download through the Storage Read API; batches are yielded as they arrive
+    # instead of materializing the result as Row objects.
+    return job.result(page_size=PAGE_SIZE).to_arrow_iterable(bqstorage_client=bq_storage)
+
+def read_rows_after(bq_storage: bigquery_storage.BigQueryReadClient,
+                    watermark: str) -> Iterator[pa.RecordBatch]:
+    """
+    Read changed rows straight from the table with the Storage Read API, with
+    no query job at all (BQ_READ_MODE=storage). Rows come back in no particular
+    order, so the caller may only checkpoint once the whole read has finished.
+    """
+    types = bigquery_storage.types
+    dataset, table = BQ_TABLE.split(".")
+    session = bq_storage.create_read_session(
+        parent=f"projects/{PROJECT}",
+        read_session=types.ReadSession(
+            table=f"projects/{PROJECT}/datasets/{dataset}/tables/{table}",
+            data_format=types.DataFormat.ARROW,
+            read_options=types.ReadSession.TableReadOptions(
+                selected_fields=list(BQ_COLUMNS),
+                row_restriction=f'updated_at > TIMESTAMP("{watermark}")',
+            ),
+        ),
+        max_stream_count=1,
+    )
+    for stream in session.streams:
+        for page in bq_storage.read_rows(stream.name).rows(session).pages:
+            batch = page.to_arrow()
+            # Arrow columns follow the table schema; put them back in BQ_COLUMNS order
+            yield pa.RecordBatch.from_arrays([batch.column(name) for name in BQ_COLUMNS],
+                                             names=list(BQ_COLUMNS))
+
+def iter_pages(batches: Iterable[pa.RecordBatch], page_size: int) -> Iterator[Iterator[pa.RecordBatch]]:
+    """
+    Group a stream of record batches into lazy pages of about `page_size` rows.
+    A new page starts at the first batch boundary past each multiple of `page_size`.
+    """
+    seen = 0
+
+    def page_of(batch: pa.RecordBatch) -> int:
+        nonlocal seen
+        page = seen // page_size
+        seen += batch.num_rows
+        return page
+
+    return (page for _, page in itertools.groupby(batches, key=page_of))
+
+def iter_prefetched(items: Iterable, maxsize: int = PREFETCH_BATCHES) -> Iterator:
+    """
+    Iterate `items` on a background thread, buffering at most `maxsize` of them,
+    so BigQuery downloads overlap with the Dataverse POSTs done by the caller.
+    An exception raised by the producer is re-raised in the consumer.
+    """
+    q: queue.Queue = queue.Queue(maxsize=maxsize)
+    done = object()
+
+    def produce():
+        try:
+            for item in items:
+                q.put((item, None))
+        except BaseException as e:
+            q.put((None, e))
+        else:
+            q.put((done, None))
+
+    threading.Thread(target=produce, name="bq-fetch", daemon=True).start()
+    while True:
+        item, err = q.get()
+        if err is not None:
+            raise err
+        if item is done:
+            return
+        yield item
 
 # ----------------------------
-# Mapping: BigQuery row -> (relative URL, body)
+# Mapping: BigQuery record batch -> [(relative URL, body)]
 # ----------------------------
-def map_row_to_request(row) -> Tuple[str, dict]:
+# Dataverse columns (logical names) for externalid, name, email, phone
+# (if your column logical names differ, change here)
+DV_FIELDS = ("new_externalid", "name", "emailaddress1", "telephone1")
+
+# The schema is fixed, so the constant JSON/URL fragments are encoded once and
+# each row only serializes its four values.
+BODY_KEYS = tuple((b"{" if i == 0 else b",") + json_dumps(field) + b":" for i, field in enumerate(DV_FIELDS))
+URL_PREFIX = f"{DV_ENTITY}({ALT_KEY_NAME}='".encode("utf-8")
+URL_SUFFIX = b"')"
+
+def map_batch_to_requests(batch: pa.RecordBatch) -> List[Tuple[bytes, bytes]]:
     """
-    Return:
-      url_path: e.g., "new_customers(externalid='CUST001')"
+    Return one (url_path, body) per row, both already encoded:
+      url_path: e.g., b"new_customers(externalid='CUST001')"
       body:     JSON payload for PATCH
+    Columns are converted to Python lists once and zipped, so no per-row
+    field lookups are needed.
     Adjust mappings here for your target table.
     """
-    # Dataverse columns (logical names)
-    body = {
-        "new_externalid": row.externalid,     # if your column logical name differs, change here
-        "name": row.name,
-        "emailaddress1": row.email,
-        "telephone1": row.phone
-    }
-
-    # PATCH by alternate key (upsert)
-    # If ext id contains quotes, escape single quotes per OData
-    ext = str(row.externalid).replace("'", "''") if row.externalid is not None else ""
-    url_path = f"{DV_ENTITY}({ALT_KEY_NAME}='{ext}')"
-    return url_path, body
+    key_ext, key_name, key_email, key_phone = BODY_KEYS
+    join = b"".join
+    changes = []
+    for externalid, name, email, phone in zip(
+        batch.column(COL_EXTERNALID).to_pylist(),
+        batch.column(COL_NAME).to_pylist(),
+        batch.column(COL_EMAIL).to_pylist(),
+        batch.column(COL_PHONE).to_pylist(),
+    ):
+        body = join((key_ext, json_dumps(externalid), key_name, json_dumps(name),
+                     key_email, json_dumps(email), key_phone, json_dumps(phone), b"}"))
+
+        # PATCH by alternate key (upsert)
+        # If ext id contains quotes, escape single quotes per OData
+        if externalid is None:
+            ext = ""
+        elif SAFE_EXTERNALID:
+            ext = str(externalid)
+        else:
+            ext = str(externalid).translate(ODATA_QUOTE_ESCAPE)
+        changes.append((URL_PREFIX + ext.encode("utf-8") + URL_SUFFIX, body))
+    return changes
 
 # ----------------------------
 # HTTP helpers with retry/backoff
 # ----------------------------
-def rand_jitter():
-    return random.uniform(0.0, 0.5)
+def request_with_retry(method: str, url: str, headers: dict, data: bytes = None) -> requests.Response:
+    # Retries happen in the session adapter (see RETRY); anything left is final.
+    resp = SESSION.request(method, url, headers=headers, data=data, timeout=HTTP_TIMEOUT)
+    if resp.status_code in (200, 201, 202, 204):
+        return resp
 
-def should_retry(status: int) -> bool:
-    return status in (429, 500, 502, 503, 504)
+    # hard failure
+    log.error("HTTP %s failed: %s %s", method, resp.status_code, resp.text[:500])
+    resp.raise_for_status()
 
-def request_with_retry(method: str, url: str, headers: dict, data: bytes = None) -> requests.Response:
-    attempt = 0
-    while True:
-        resp = requests.request(method, url, headers=headers, data=data)
-        if resp.status_code in (200, 201, 202, 204):
-            return resp
-
-        if should_retry(resp.status_code) and attempt < MAX_RETRIES:
-            attempt += 1
-            retry_after = resp.headers.get("Retry-After")
-            if retry_after:
-                try:
-                    wait = float(retry_after)
-                except ValueError:
-                    wait = BASE_BACKOFF * (2 ** (attempt - 1)) + rand_jitter()
-            else:
-                wait = BASE_BACKOFF * (2 ** (attempt - 1)) + rand_jitter()
-            log.warning("HTTP %s -> %s. Retrying in %.2fs (attempt %d/%d)",
-                        method, resp.status_code, wait, attempt, MAX_RETRIES)
-            time.sleep(wait)
-            continue
+# ----------------------------
+# Parse a Dataverse $batch response
+# ----------------------------
+_PART_DELIMITER = re.compile(rb"^--[^\r\n]+\r?$", re.M)
+_INNER_STATUS = re.compile(rb"^HTTP/1\.1 (\d{3})", re.M)
+_CONTENT_ID = re.compile(rb"^Content-ID:[ \t]*(\d+)", re.M | re.I)
 
-        # hard failure
-        log.error("HTTP %s failed: %s %s", method, resp.status_code, resp.text[:500])
-        resp.raise_for_status()
+def parse_batch_response(resp: requests.Response) -> List[Tuple[Optional[int], int, bytes]]:
+    """
+    Return (content_id, status, body) for every inner response of a $batch reply.
+    content_id is the request's 1-based position in the change set, or None
+    when Dataverse did not echo it (e.g. an error for the whole change set).
+    """
+    results = []
+    for part in _PART_DELIMITER.split(resp.content):
+        status = _INNER_STATUS.search(part)
+        if not status:
+            continue
+        cid = _CONTENT_ID.search(part, 0, status.start())
+        _, _, body = part[status.end():].partition(b"\r\n\r\n")
+        results.append((int(cid.group(1)) if cid else None, int(status.group(1)), body.strip()))
+    return results
 
 # ----------------------------
 # Build a Dataverse $batch body
 # ----------------------------
-def build_batch_payload(changes: List[Tuple[str, dict]]) -> Tuple[str, bytes]:
+# Constant parts of each changeset request, encoded once
+PART_HEADERS = b"Content-Type: application/http\r\nContent-Transfer-Encoding: binary\r\n"
+# Note: absolute path required after /api/data/v9.2/
+PATCH_PREFIX = f"PATCH {DATAVERSE_URL}/api/data/v9.2/".encode("utf-8")
+# 'Prefer: return=representation' if you want the created/updated entity back
+JSON_HEADERS = b"Content-Type: application/json; charset=utf-8\r\nPrefer: odata.include-annotations=*\r\n\r\n"
+
+def build_batch_payload(changes: List[Tuple[bytes, bytes]]) -> Tuple[str, bytes]:
     """
-    changes: list of (url_path, body_json)
+    changes: list of encoded (url_path, body_json)
     Returns (boundary, payload_bytes)
     Uses a single change set for transactional upserts.
+    All pieces are collected as bytes and joined once: b"".join sizes the
+    payload exactly, so it is allocated and copied a single time.
     """
-    batch_boundary = f"batch_{uuid.uuid4()}"
-    cs_boundary = f"changeset_{uuid.uuid4()}"
+    batch_boundary = f"batch_{secrets.token_hex(16)}"
+    cs_boundary = f"changeset_{secrets.token_hex(16)}"
+    cs_delim = f"--{cs_boundary}\r\n".encode("utf-8")
 
-    parts = []
     # batch start
-    parts.append(f"--{batch_boundary}\r\n")
-    parts.append(f"Content-Type: multipart/mixed;boundary={cs_boundary}\r\n\r\n")
-
-    for i, (url_path, body) in enumerate(changes):
-        # one write request
-        part = []
-        part.append(f"--{cs_boundary}\r\n")
-        part.append("Content-Type: application/http\r\n")
-        part.append("Content-Transfer-Encoding: binary\r\n\r\n")
-        # Note: absolute path required after /api/data/v9.2/
-        part.append(f"PATCH {DATAVERSE_URL}/api/data/v9.2/{url_path} HTTP/1.1\r\n")
-        part.append("Content-Type: application/json; charset=utf-8\r\n")
-        # 'Prefer: return=representation' if you want the created/updated entity back
-        part.append("Prefer: odata.include-annotations=*\r\n\r\n")
-        part.append(json.dumps(body))
-        part.append("\r\n")
-        parts.append("".join(part))
+    parts = [
+        f"--{batch_boundary}\r\n".encode("utf-8"),
+        f"Content-Type: multipart/mixed;boundary={cs_boundary}\r\n\r\n".encode("utf-8"),
+    ]
+
+    for n, (url_path, body) in enumerate(changes, 1):
+        # one write request; Content-ID (1-based) is echoed back in the response
+        parts += (
+            cs_delim,
+            PART_HEADERS,
+            b"Content-ID: %d\r\n\r\n" % n,
+            PATCH_PREFIX,
+            url_path,
+            b" HTTP/1.1\r\n",
+            JSON_HEADERS,
+            body,
+            b"\r\n",
+        )
 
     # end changeset
-    parts.append(f"--{cs_boundary}--\r\n")
+    parts.append(f"--{cs_boundary}--\r\n".encode("utf-8"))
     # end batch
-    parts.append(f"--{batch_boundary}--\r\n")
+    parts.append(f"--{batch_boundary}--\r\n".encode("utf-8"))
 
-    payload = "".join(parts).encode("utf-8")
-    return batch_boundary, payload
+    return batch_boundary, b"".join(parts)
 
-def post_batch(token: str, payload_boundary: str, payload_bytes: bytes):
+def post_batch(payload_boundary: str, payload_bytes: bytes):
     headers = {
-        "Authorization": f"Bearer {token}",
+        "Authorization": f"Bearer {acquire_token()}",  # refreshed here when close to expiry
         "Content-Type": f"multipart/mixed;boundary={payload_boundary}",
         "Accept": "application/json"
     }
+    # The multipart body is very repetitive (headers, JSON keys) and compresses well.
+    # Compressing here runs on the POST worker threads.
+    if DV_GZIP_LEVEL:
+        payload_bytes = gzip.compress(payload_bytes, compresslevel=DV_GZIP_LEVEL)
+        headers["Content-Encoding"] = "gzip"
     url = f"{DATAVERSE_URL}/api/data/v9.2/$batch"
     return request_with_retry("POST", url, headers=headers, data=payload_bytes)
 
+def post_chunk(chunk: List[Tuple[bytes, bytes]], boundary: str, payload: bytes,
+               retries_left: int = INNER_RETRIES) -> int:
+    """
+    POST one change set and check every inner response, not just the outer status.
+    The change set is atomic, so after any inner failure nothing was applied:
+    the rows that did not fail are posted again, rows that failed with a
+    retryable status are retried in their own smaller batch, and any other
+    failure raises so the page's watermark does not advance.
+    The chunk only counts as done when every request (Content-ID 1..len(chunk))
+    has its own 2xx inner response. Returns the HTTP status of the last $batch
+    POST; the response itself (and the payload it references) is not kept.
+    """
+    resp = post_batch(boundary, payload)
+    inner = parse_batch_response(resp)
+    failed = {cid: (status, body) for cid, status, body in inner if not 200 <= status < 300}
+    if not failed:
+        confirmed = sorted(cid for cid, _, _ in inner if cid is not None)
+        if confirmed != list(range(1, len(chunk) + 1)) or len(inner) != len(chunk):
+            raise RuntimeError(f"$batch response confirmed {len(inner)} of {len(chunk)} upserts "
+                               f"(HTTP {resp.status_code}, Content-IDs {confirmed[:10]})")
+        return resp.status_code
+
+    if None in failed or not all(1 <= cid <= len(chunk) for cid in failed):
+        raise RuntimeError(f"$batch change set failed: {failed}")
+    for cid, (status, body) in sorted(failed.items()):
+        log.warning("Batch row %s failed: HTTP %s %s", chunk[cid-1][0].decode("utf-8"), status, body[:500])
+
+    ok = [change for n, change in enumerate(chunk, 1) if n not in failed]
+    if ok:
+        post_chunk(ok, *build_batch_payload(ok), retries_left=retries_left)
+
+    if retries_left <= 0 or any(status not in RETRYABLE_STATUSES for status, _ in failed.values()):
+        raise RuntimeError(f"{len(failed)} of {len(chunk)} upserts failed in $batch")
+    retry = [chunk[cid-1] for cid in sorted(failed)]
+    return post_chunk(retry, *build_batch_payload(retry), retries_left=retries_left-1)
+
+def _chunk_done(errors: List[BaseException], slots: threading.Semaphore, fut: Future) -> None:
+    # Record the failure before freeing the slot so a sender woken by the
+    # release already sees it and does not post another chunk.
+    if not fut.cancelled() and fut.exception() is not None:
+        errors.append(fut.exception())
+    slots.release()
+
+def submit_chunk(executor: ThreadPoolExecutor, chunk: List[Tuple[bytes, bytes]],
+                 errors: List[BaseException], slots: threading.Semaphore) -> Future:
+    """
+    Queue a chunk for POSTing; if it fails, its exception is appended to `errors`.
+    Blocks until one of the `slots` is free, so at most CHUNKS_IN_FLIGHT built
+    payloads exist at once however large a page is.
+    """
+    slots.acquire()
+    if errors:
+        slots.release()
+        raise errors[0]
+    boundary, payload = build_batch_payload(chunk)
+    fut = executor.submit(post_chunk, chunk, boundary, payload)
+    fut.add_done_callback(functools.partial(_chunk_done, errors, slots))
+    return fut
+
+def raise_if_failed(errors: List[BaseException], last_checkpoint: Optional[Future]) -> None:
+    """Stop building pages as soon as any chunk or checkpoint has failed."""
+    if errors:
+        raise errors[0]
+    if last_checkpoint is not None and last_checkpoint.done() and last_checkpoint.exception():
+        raise last_checkpoint.exception()
+
+def drop_finished(chunks: Dict[Future, Tuple[int, int]]) -> None:
+    """
+    Forget chunks that have already succeeded, so a page with no row limit
+    (storage mode) does not hold one future per chunk until the end of the run.
+    Failed chunks are kept for checkpoint_page to re-raise.
+    """
+    for fut in [f for f in chunks if f.done() and not f.cancelled() and f.exception() is None]:
+        first, last = chunks.pop(fut)
+        log.debug("Batch chunk %d-%d response status: %s", first, last, fut.result())
+
+def checkpoint_page(previous: Optional[Future], chunks: Dict[Future, Tuple[int, int]],
+                    page_rows: int, wm: str) -> Tuple[int, str]:
+    """
+    Wait for every chunk of a page, then persist its watermark.
+    Runs on a single checkpoint thread, so pages are checkpointed in the order
+    they were emitted; `previous` is the preceding page's checkpoint and
+    re-raises its failure, so the watermark never moves past a failed page.
+    Returns (page_rows, wm).
+    """
+    if previous is not None:
+        previous.result()
+    for fut in as_completed(chunks):
+        first, last = chunks[fut]
+        status = fut.result()  # re-raises if the chunk (or any row in it) failed
+        log.debug("Batch chunk %d-%d response status: %s", first, last, status)
+    save_watermark(wm)
+    log.info("Page of %d rows done. Watermark advanced to %s.", page_rows, wm)
+    return page_rows, wm
+
 # ----------------------------
 # Main processing loop
 # ----------------------------
 def run_once():
     if not all([PROJECT, DATAVERSE_URL, TENANT_ID, CLIENT_ID, CLIENT_SECRET]):
         raise RuntimeError("Missing required configuration (.env)")
+    if not 0 <= DV_GZIP_LEVEL <= 9:
+        raise RuntimeError(f"DV_GZIP_LEVEL must be 0-9, got {DV_GZIP_LEVEL}")
+    if BQ_READ_MODE not in ("query", "storage"):
+        raise RuntimeError(f"BQ_READ_MODE must be 'query' or 'storage', got {BQ_READ_MODE!r}")
+    if BQ_READ_MODE == "storage" and MAX_BATCH_PER_RUN:
+        # An unordered read can only be checkpointed once it is complete, so
+        # stopping early would never move the watermark.
+        raise RuntimeError("MAX_BATCH_PER_RUN is not supported with BQ_READ_MODE=storage")
 
     bq = bigquery.Client(project=PROJECT)
-    token = acquire_token()
+    bq_storage = bigquery_storage.BigQueryReadClient()
+    acquire_token()  # fail fast on bad credentials
     log.info("Token acquired. Starting sync...")
 
     watermark = load_watermark()
     log.info("Loaded watermark: %s", watermark)
 
     total_processed = 0
+    total_submitted = 0
     newest_wm = watermark
 
-    while True:
-        # Hard cap to limit per execution if configured
-        if MAX_BATCH_PER_RUN and total_processed >= MAX_BATCH_PER_RUN:
-            log.info("Reached MAX_BATCH_PER_RUN=%s, stopping.", MAX_BATCH_PER_RUN)
-            break
-
-        rows = fetch_rows_after(bq, newest_wm, PAGE_SIZE)
-        if not rows:
-            log.info("No more rows after %s. Done.", newest_wm)
-            break
-
-        log.info("Fetched %d rows from BigQuery (after %s).", len(rows), newest_wm)
-
-        # Convert BigQuery row -> requests, track last updated_at
-        changes: List[Tuple[str, dict]] = []
-        page_latest = newest_wm
-        for r in rows:
-            url_path, body = map_row_to_request(r)
-            changes.append((url_path, body))
-
-            # updated_at can be datetime or string
-            ru = r.updated_at
-            if isinstance(ru, str):
-                cand = ru
-            else:
-                # ensure UTC ISO format with Z
-                if ru.tzinfo is None:
-                    ru = ru.replace(tzinfo=pytz.UTC)
-                cand = ru.isoformat().replace("+00:00", "Z")
-            if cand > page_latest:
-                page_latest = cand
-
-        # Send in chunks to respect payload size & throttling
-        for i in range(0, len(changes), BATCH_SIZE):
-            chunk = changes[i:i+BATCH_SIZE]
-            boundary, payload = build_batch_payload(chunk)
-            log.info("Posting batch chunk %d-%d (%d records)...", i+1, i+len(chunk), len(chunk))
-            resp = post_batch(token, boundary, payload)
-            # Optional: parse multipart response for per-row diagnostics
-            log.debug("Batch response status: %s", resp.status_code)
-
-        newest_wm = page_latest
-        total_processed += len(rows)
-        save_watermark(newest_wm)
-        log.info("Processed %d rows. Watermark advanced to %s.", total_processed, newest_wm)
-
-        # If we got less than PAGE_SIZE, we're done
-        if len(rows) < PAGE_SIZE:
-            log.info("Final page processed.")
-            break
+    # A single query covers the whole run; its result is checkpointed in pages of
+    # PAGE_SIZE rows. A direct table read is unordered, so it is one page.
+    # Pipeline: BigQuery fetch thread -> this thread (map + build payloads)
+    #           -> POST pool -> checkpoint thread (saves watermarks in page order).
+    if BQ_READ_MODE == "storage":
+        batches = iter_prefetched(read_rows_after(bq_storage, watermark))
+        page_size = sys.maxsize
+    else:
+        batches = iter_prefetched(fetch_rows_after(bq, bq_storage, watermark))
+        page_size = PAGE_SIZE
+    checkpoints = collections.deque()
+    last_checkpoint = None
+
+    chunk_errors: List[BaseException] = []
+    chunk_slots = threading.BoundedSemaphore(CHUNKS_IN_FLIGHT)
+    executor = ThreadPoolExecutor(max_workers=DV_CONCURRENCY, thread_name_prefix="dv-post")
+    checkpointer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dv-checkpoint")
+    try:
+        for page in iter_pages(batches, page_size):
+            raise_if_failed(chunk_errors, last_checkpoint)
+
+            # Hard cap to limit per execution if configured
+            if MAX_BATCH_PER_RUN and total_submitted >= MAX_BATCH_PER_RUN:
+                log.info("Reached MAX_BATCH_PER_RUN=%s, stopping.", MAX_BATCH_PER_RUN)
+                break
+
+            # Stream the page; each full chunk is posted as soon as it is mapped
+            # (chunks are posted concurrently). The page is then handed to the
+            # checkpoint thread and the next page is built without waiting.
+            page_rows = 0
+            last_updated = None
+            pending: List[Tuple[bytes, bytes]] = []
+            futures = {}
+            for batch in page:
+                pending.extend(map_batch_to_requests(batch))
+
+                # Track the page's newest updated_at with one vectorized max per
+                # batch, which also holds when rows are not ordered (storage mode).
+                if batch.num_rows:
+                    batch_latest = pc.max(batch.column(COL_UPDATED_AT)).as_py()
+                    if last_updated is None or batch_latest > last_updated:
+                        last_updated = batch_latest
+
+                raise_if_failed(chunk_errors, last_checkpoint)
+
+                # Send in chunks to respect payload size & throttling
+                full = len(pending) - len(pending) % BATCH_SIZE
+                for start in range(0, full, BATCH_SIZE):
+                    chunk = pending[start:start+BATCH_SIZE]
+                    log.debug("Posting batch chunk %d-%d (%d records)...",
+                              page_rows+1, page_rows+len(chunk), len(chunk))
+                    futures[submit_chunk(executor, chunk, chunk_errors, chunk_slots)] = (page_rows+1, page_rows+len(chunk))
+                    page_rows += len(chunk)
+                    if len(futures) >= 2 * CHUNKS_IN_FLIGHT:
+                        drop_finished(futures)
+                pending = pending[full:]  # carry the partial chunk into the next batch
+
+            if pending:
+                log.debug("Posting batch chunk %d-%d (%d records)...",
+                          page_rows+1, page_rows+len(pending), len(pending))
+                futures[submit_chunk(executor, pending, chunk_errors, chunk_slots)] = (page_rows+1, page_rows+len(pending))
+                page_rows += len(pending)
+
+            if not page_rows:
+                continue
+
+            log.debug("Fetched %d rows from BigQuery.", page_rows)
+            total_submitted += page_rows
+
+            last_checkpoint = checkpointer.submit(checkpoint_page, last_checkpoint, futures,
+                                                  page_rows, to_watermark(last_updated))
+            checkpoints.append(last_checkpoint)
+
+            # Backpressure: bound how far building runs ahead of Dataverse
+            while len(checkpoints) > PAGES_IN_FLIGHT:
+                rows, newest_wm = checkpoints.popleft().result()
+                total_processed += rows
+
+        while checkpoints:
+            rows, newest_wm = checkpoints.popleft().result()
+            total_processed += rows
+    except BaseException:
+        # Nothing queued may still be POSTed: the failed page's watermark (and so
+        # any later page's) will never be saved.
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    finally:
+        executor.shutdown(wait=True)
+        checkpointer.shutdown(wait=True)  # pages that fully succeeded still get saved
+
+    if not total_processed:
+        log.info("No more rows after %s. Done.", watermark)
 
     log.info("Sync complete. Total upserts: %d. Final watermark: %s", total_processed, newest_wm)
 
 if __name__ == "__main__":
+    # Everything loaded so far (modules, clients, constants) lives for the whole
+    # run; move it out of the GC generations so collections only scan new objects.
+    gc.freeze()
     try:
         run_once()
     except Exception as e: